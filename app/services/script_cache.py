@@ -4,82 +4,392 @@ Topic Usage Cache Service
 This module tracks which topics have been used for video generation
 to prevent repetitive content. It maintains a 90-day history and
 helps select unused or least-recently-used topics.
+
+New usages are buffered, appended in batches to a JSON-lines log next
+to the cache file (topic_history.jsonl), and the log is compacted back
+into the JSON snapshot when it grows large and at interpreter exit.
 """
 
+import atexit
+import bisect
 import json
 import os
+import random
+import threading
+import time
+from itertools import islice
+from operator import itemgetter
 from pathlib import Path
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Tuple, Any, BinaryIO
 from loguru import logger
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
-# Cache file location - in config directory so it can be committed
+# Cache file location - in config directory so it can be committed.
+# After a clean exit the snapshot holds the full history; until then recent
+# usages may only be in topic_history.jsonl next to it.
 CACHE_DIR = Path(__file__).parent.parent.parent / "config"
 CACHE_FILE = CACHE_DIR / "topic_history.json"
 
 # How long to retain topic usage history (90 days)
 RETENTION_DAYS = 90
 
+# Minimum number of appended log entries before compacting into the snapshot
+COMPACT_MIN_ENTRIES = 1000
+
+# Pending usages are flushed to the log after this many records or seconds;
+# a usage recorded after a quiet period is written straight away
+SAVE_BATCH = 16
+SAVE_INTERVAL_SEC = 5
+
+
+def _dumps(obj: Any, indent: bool = False) -> bytes:
+    """
+    Serialize to UTF-8 JSON, using orjson when it is installed.
+    
+    Log lines are written compact; indent is only used for the snapshot,
+    which is rewritten at compaction and kept readable for git diffs.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    if indent:
+        return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def _loads(data: bytes) -> Any:
+    """Parse UTF-8 JSON, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _parse_ts(value: str) -> float:
+    """Convert an ISO-8601 timestamp to epoch seconds."""
+    return datetime.fromisoformat(value).timestamp()
+
+
+def _format_ts(ts: float) -> str:
+    """Convert epoch seconds to an ISO-8601 timestamp."""
+    return datetime.fromtimestamp(ts).isoformat()
+
 
 class TopicCache:
     """
     Manages topic usage history to prevent repetitive content.
     
-    The cache stores:
+    The cache stores, per channel, one record per topic:
     - topic: The topic string
-    - channel: Which channel used it
-    - timestamp: When it was used
     - count: How many times used in retention period
+    - timestamps: When it was used, oldest first
     """
     
     def __init__(self, cache_file: Path = CACHE_FILE):
         self.cache_file = cache_file
-        self.history: List[Dict[str, Any]] = []
-        self._load_cache()
+        self.log_file = cache_file.with_suffix('.jsonl')
+        # channel -> topic -> {'count': int, 'timestamps': [epoch seconds]}
+        self._by_channel: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        # Per-channel topics ordered from least to most recently used
+        # (plain dicts keep insertion order and iterate in reverse)
+        self._recent: Dict[str, Dict[str, None]] = {}
+        self._log_handle: Optional[BinaryIO] = None
+        # Set when the log's last line was cut off by a crash mid-append
+        self._log_unterminated = False
+        self._appended_since_compact = 0
+        # Sequence number of the last usage recorded; the snapshot stores the
+        # last one it contains so log replay never depends on the wall clock
+        self._seq = 0
+        # Usages recorded but not yet written to the log
+        self._pending: List[Dict[str, Any]] = []
+        self._last_save_ts = float('-inf')
+        # Flushes pending usages that no later record_usage call picks up
+        self._flush_timer: Optional[threading.Timer] = None
+        self._lock = threading.RLock()
+        # Set when expired usages were dropped and the snapshot is stale
+        self._dirty = False
+        # Set when the snapshot on disk could not be read; it must not be
+        # overwritten, so usages keep going to the log instead
+        self._snapshot_readonly = False
+        # The cache file is read on first use rather than on construction
+        self._loaded = False
+        atexit.register(self._shutdown)
+    
+    def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        # Scheduler jobs run in worker threads; none may query a half-loaded cache
+        with self._lock:
+            if not self._loaded:
+                try:
+                    self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+                except OSError as e:
+                    # Selection still works from memory; writes log their own errors
+                    logger.error(f"Failed to create topic cache directory: {e}")
+                self._load_cache()
+                self._loaded = True
     
     def _load_cache(self) -> None:
-        """Load cache from disk and clean expired entries."""
+        """Load the snapshot and replay the append log, skipping expired entries."""
+        cutoff_iso = (datetime.now() - timedelta(days=RETENTION_DAYS)).isoformat()
+        expired = 0
+        folded_seq = 0
         if self.cache_file.exists():
             try:
-                with open(self.cache_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    self.history = data.get('history', [])
-                    logger.info(f"Loaded {len(self.history)} topic history entries")
+                data = _loads(self.cache_file.read_bytes())
+                for channel, records in data.get('channels', {}).items():
+                    for record in records:
+                        for timestamp in record['timestamps']:
+                            if not self._load_usage(channel, record['topic'], timestamp, cutoff_iso):
+                                expired += 1
+                # Older snapshots stored one entry per usage
+                for entry in data.get('history', []):
+                    if not self._load_usage(entry['channel'], entry['topic'], entry['timestamp'], cutoff_iso):
+                        expired += 1
+                folded_seq = data.get('log_seq', 0)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                logger.warning(f"Failed to parse topic cache: {e}")
+                self._by_channel = {}
+                # Keep the unreadable snapshot around instead of letting the
+                # next compaction overwrite it with a near-empty history
+                corrupt_file = self.cache_file.with_suffix(self.cache_file.suffix + '.corrupt')
+                try:
+                    os.replace(self.cache_file, corrupt_file)
+                    logger.warning(f"Moved unreadable topic cache to {corrupt_file}")
+                except OSError as e:
+                    logger.error(f"Failed to move unreadable topic cache: {e}")
+                    self._snapshot_readonly = True
+            except Exception as e:
+                # I/O or permission trouble says nothing about the content;
+                # leave the file where it is
+                logger.error(f"Failed to read topic cache, not overwriting it: {e}")
+                self._by_channel = {}
+                self._snapshot_readonly = True
+        
+        if self.log_file.exists():
+            try:
+                with open(self.log_file, 'rb') as f:
+                    line = b""
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        try:
+                            entry = _loads(line)
+                        except ValueError:
+                            # Most likely a line cut short by a crash mid-append
+                            logger.warning(f"Skipping malformed topic log line: {line[:80]!r}")
+                            continue
+                        if 'channel' not in entry:
+                            # Header written by compaction: numbering continues from here
+                            self._seq = max(self._seq, entry.get('log_seq', 0))
+                            continue
+                        seq = entry.get('seq', 0)
+                        self._seq = max(self._seq, seq)
+                        # Already folded into the snapshot by an interrupted compaction
+                        if seq and seq <= folded_seq:
+                            continue
+                        if not self._load_usage(entry['channel'], entry['topic'], entry['timestamp'], cutoff_iso):
+                            expired += 1
+                        self._appended_since_compact += 1
+                # Without a newline the next append would be glued onto this line
+                self._log_unterminated = bool(line) and not line.endswith(b"\n")
             except Exception as e:
-                logger.warning(f"Failed to load topic cache: {e}")
-                self.history = []
+                logger.warning(f"Failed to load topic log: {e}")
+        
+        self._seq = max(self._seq, folded_seq)
+        total = sum(
+            record['count'] for bucket in self._by_channel.values() for record in bucket.values()
+        )
+        logger.info(f"Loaded {total} topic usages across {len(self._by_channel)} channels")
+        self._rebuild_index()
+        
+        if expired > 0:
+            logger.info(f"Cleaned up {expired} expired topic history entries")
+            # Persisted by the next flush rather than right away
+            self._dirty = True
         
         # Clean expired entries
         self._cleanup_expired()
     
+    def _load_usage(self, channel: str, topic: str, timestamp: str, cutoff_iso: str) -> bool:
+        """Add a stored usage unless it is expired; returns False if it was skipped."""
+        # ISO-8601 timestamps sort chronologically, so expired usages are
+        # recognised without parsing them
+        if timestamp <= cutoff_iso:
+            return False
+        self._add_usage(channel, topic, _parse_ts(timestamp))
+        return True
+    
+    def _add_usage(self, channel: str, topic: str, ts: float) -> None:
+        bucket = self._by_channel.setdefault(channel, {})
+        record = bucket.setdefault(topic, {'count': 0, 'timestamps': []})
+        record['count'] += 1
+        # Keep timestamps sorted so expiry can bisect; new usages land at the end
+        bisect.insort(record['timestamps'], ts)
+    
+    def _rebuild_index(self) -> None:
+        """Rebuild the per-channel recency order from records."""
+        self._recent = {}
+        by_last_used = itemgetter(0)
+        for channel, bucket in self._by_channel.items():
+            last_used = [(record['timestamps'][-1], topic) for topic, record in bucket.items()]
+            last_used.sort(key=by_last_used)
+            for _, topic in last_used:
+                self._index_add(channel, topic)
+    
+    def _index_add(self, channel: str, topic: str) -> None:
+        recent = self._recent.setdefault(channel, {})
+        recent.pop(topic, None)
+        recent[topic] = None
+    
+    def _index_remove(self, channel: str, topic: str) -> None:
+        recent = self._recent.get(channel)
+        if recent is not None:
+            recent.pop(topic, None)
+            if not recent:
+                del self._recent[channel]
+    
+    def _maybe_save(self) -> None:
+        """Flush pending entries once enough have accumulated or enough time passed."""
+        if (len(self._pending) >= SAVE_BATCH
+                or time.monotonic() - self._last_save_ts > SAVE_INTERVAL_SEC):
+            self._save_cache()
+        elif self._flush_timer is None:
+            self._flush_timer = threading.Timer(SAVE_INTERVAL_SEC, self._save_cache)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+    
     def _save_cache(self) -> None:
-        """Save cache to disk."""
+        """Append all pending entries to the log in a single write."""
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            self._flush()
+    
+    def _shutdown(self) -> None:
+        """Fold everything into the snapshot at exit, so it can be committed on its own."""
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if self._loaded and (self._pending or self._dirty or self._appended_since_compact):
+                if self._compact():
+                    return
+            # Compaction not possible (e.g. unreadable snapshot); keep usages in the log
+            self._flush()
+    
+    def _flush(self) -> None:
+        """Write pending entries (or compact if the snapshot is stale); caller holds the lock."""
+        # The snapshot must be rewritten anyway; it takes the pending entries
+        # too. If that fails, fall back to appending them to the log.
+        if self._dirty and self._compact():
+            return
+        if not self._pending:
+            return
+        try:
+            if self._log_handle is None:
+                self._log_handle = open(self.log_file, 'ab')
+            data = b"".join(_dumps(entry) + b"\n" for entry in self._pending)
+            if self._log_unterminated:
+                data = b"\n" + data
+            self._log_handle.write(data)
+            self._log_handle.flush()
+            self._log_unterminated = False
+        except Exception as e:
+            logger.error(f"Failed to append topic usage: {e}")
+            return
+        self._appended_since_compact += len(self._pending)
+        self._pending.clear()
+        self._last_save_ts = time.monotonic()
+        self._maybe_compact()
+    
+    def _maybe_compact(self) -> None:
+        """Compact once the log holds more lines than the snapshot has records."""
+        records = sum(len(bucket) for bucket in self._by_channel.values())
+        if self._appended_since_compact > max(COMPACT_MIN_ENTRIES, records):
+            self._compact()
+    
+    def _compact(self) -> bool:
+        """Rewrite the snapshot with the live records and truncate the log; False if skipped or failed."""
+        if self._snapshot_readonly:
+            return False
+        tmp_file = self.cache_file.with_suffix(self.cache_file.suffix + '.tmp')
         try:
-            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
-            with open(self.cache_file, 'w', encoding='utf-8') as f:
-                json.dump({
+            with open(tmp_file, 'wb') as f:
+                f.write(_dumps({
                     'last_updated': datetime.now().isoformat(),
-                    'history': self.history
-                }, f, indent=2, ensure_ascii=False)
-            logger.debug(f"Saved {len(self.history)} topic history entries")
+                    'log_seq': self._seq,
+                    'channels': {
+                        channel: [
+                            {
+                                'topic': topic,
+                                'count': record['count'],
+                                'timestamps': [_format_ts(ts) for ts in record['timestamps']]
+                            }
+                            for topic, record in bucket.items()
+                        ]
+                        for channel, bucket in self._by_channel.items()
+                    }
+                }, indent=True))
+                # The log is deleted right after, so the snapshot must be durable
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.cache_file)
         except Exception as e:
             logger.error(f"Failed to save topic cache: {e}")
+            tmp_file.unlink(missing_ok=True)
+            return False
+        
+        # Pending entries are part of the snapshot now
+        self._pending.clear()
+        self._dirty = False
+        self._last_save_ts = time.monotonic()
+        if self._log_handle is not None:
+            self._log_handle.close()
+            self._log_handle = None
+        self._log_unterminated = False
+        # Start a fresh log that remembers the sequence base, so numbering
+        # stays unique even if the snapshot later cannot be read
+        tmp_log = self.log_file.with_suffix(self.log_file.suffix + '.tmp')
+        try:
+            tmp_log.write_bytes(_dumps({'log_seq': self._seq}) + b"\n")
+            os.replace(tmp_log, self.log_file)
+        except OSError as e:
+            logger.warning(f"Failed to truncate topic log: {e}")
+            tmp_log.unlink(missing_ok=True)
+        self._appended_since_compact = 0
+        logger.debug(f"Compacted topic history for {len(self._by_channel)} channels")
+        return True
     
     def _cleanup_expired(self) -> None:
-        """Remove entries older than RETENTION_DAYS."""
-        cutoff = datetime.now() - timedelta(days=RETENTION_DAYS)
-        original_count = len(self.history)
-        
-        self.history = [
-            entry for entry in self.history
-            if datetime.fromisoformat(entry['timestamp']) > cutoff
-        ]
+        """Remove usages older than RETENTION_DAYS."""
+        cutoff = (datetime.now() - timedelta(days=RETENTION_DAYS)).timestamp()
+        removed = 0
+        for channel, bucket in list(self._by_channel.items()):
+            for topic, record in list(bucket.items()):
+                timestamps = record['timestamps']
+                idx = bisect.bisect_right(timestamps, cutoff)
+                if not idx:
+                    continue
+                removed += idx
+                if idx < len(timestamps):
+                    del timestamps[:idx]
+                    record['count'] = len(timestamps)
+                else:
+                    del bucket[topic]
+                    self._index_remove(channel, topic)
+            if not bucket:
+                del self._by_channel[channel]
         
-        removed = original_count - len(self.history)
         if removed > 0:
             logger.info(f"Cleaned up {removed} expired topic history entries")
-            self._save_cache()
+            # Persisted by the next flush rather than right away
+            self._dirty = True
     
     def record_usage(self, channel: str, topic: str) -> None:
         """
@@ -89,12 +399,19 @@ class TopicCache:
             channel: Channel name
             topic: Topic string that was used
         """
-        self.history.append({
-            'channel': channel,
-            'topic': topic,
-            'timestamp': datetime.now().isoformat()
-        })
-        self._save_cache()
+        self._ensure_loaded()
+        now = datetime.now()
+        with self._lock:
+            self._add_usage(channel, topic, now.timestamp())
+            self._index_add(channel, topic)
+            self._seq += 1
+            self._pending.append({
+                'seq': self._seq,
+                'channel': channel,
+                'topic': topic,
+                'timestamp': now.isoformat()
+            })
+            self._maybe_save()
         logger.info(f"Recorded topic usage: {channel} -> {topic[:50]}...")
     
     def get_usage_count(self, channel: str, topic: str) -> int:
@@ -108,10 +425,9 @@ class TopicCache:
         Returns:
             Number of times used
         """
-        return sum(
-            1 for entry in self.history
-            if entry['channel'] == channel and entry['topic'] == topic
-        )
+        self._ensure_loaded()
+        record = self._by_channel.get(channel, {}).get(topic)
+        return record['count'] if record else 0
     
     def get_recent_topics(self, channel: str, limit: int = 10) -> List[str]:
         """
@@ -124,23 +440,11 @@ class TopicCache:
         Returns:
             List of recently used topic strings
         """
-        channel_entries = [
-            entry for entry in self.history
-            if entry['channel'] == channel
-        ]
-        # Sort by timestamp descending
-        channel_entries.sort(key=lambda x: x['timestamp'], reverse=True)
-        
-        # Return unique topics in order
-        seen = set()
-        result = []
-        for entry in channel_entries:
-            if entry['topic'] not in seen:
-                seen.add(entry['topic'])
-                result.append(entry['topic'])
-                if len(result) >= limit:
-                    break
-        return result
+        self._ensure_loaded()
+        recent = self._recent.get(channel)
+        if not recent:
+            return []
+        return list(islice(reversed(recent), limit))
     
     def get_unused_topic(self, channel: str, available_topics: List[str]) -> Optional[str]:
         """
@@ -153,15 +457,11 @@ class TopicCache:
         Returns:
             An unused topic, or None if all have been used
         """
-        used_topics = set(
-            entry['topic'] for entry in self.history
-            if entry['channel'] == channel
-        )
-        
-        unused = [t for t in available_topics if t not in used_topics]
+        self._ensure_loaded()
+        used = self._by_channel.get(channel, {})
+        unused = [t for t in available_topics if t not in used]
         
         if unused:
-            import random
             return random.choice(unused)
         
         return None
@@ -178,20 +478,27 @@ class TopicCache:
         Returns:
             The least used topic
         """
-        import random
-        
-        # Count usage for each topic
-        usage_counts = {}
-        for topic in available_topics:
-            usage_counts[topic] = self.get_usage_count(channel, topic)
-        
-        # Find minimum count
-        min_count = min(usage_counts.values())
+        self._ensure_loaded()
+        topic, _ = self._select(channel, available_topics)
+        return topic
+    
+    def _select(self, channel: str, available_topics: List[str]) -> Tuple[str, int]:
+        """Pick randomly among the least used topics; unused ones count as 0."""
+        bucket = self._by_channel.get(channel, {})
         
-        # Get all topics with minimum count
-        least_used = [t for t, c in usage_counts.items() if c == min_count]
+        # Track the minimum count and the topics that have it in one pass
+        min_count = None
+        least_used: List[str] = []
+        for t in dict.fromkeys(available_topics):
+            record = bucket.get(t)
+            count = record['count'] if record else 0
+            if min_count is None or count < min_count:
+                min_count = count
+                least_used = [t]
+            elif count == min_count:
+                least_used.append(t)
         
-        return random.choice(least_used)
+        return random.choice(least_used), min_count
     
     def get_smart_topic(self, channel: str, available_topics: List[str]) -> str:
         """
@@ -204,15 +511,15 @@ class TopicCache:
         Returns:
             Selected topic
         """
-        # First try to get an unused topic
-        unused = self.get_unused_topic(channel, available_topics)
-        if unused:
+        self._ensure_loaded()
+        # Unused topics have the minimum possible count, so a single
+        # least-used pass also prefers them
+        topic, count = self._select(channel, available_topics)
+        if count == 0:
             logger.info(f"Selected unused topic for {channel}")
-            return unused
-        
-        # Fall back to least used
-        logger.info(f"All topics used for {channel}, selecting least used")
-        return self.get_least_used_topic(channel, available_topics)
+        else:
+            logger.info(f"All topics used for {channel}, selecting least used")
+        return topic
 
 
 # Global instance for easy access
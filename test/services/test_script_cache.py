@@ -0,0 +1,319 @@
+import unittest
+import json
+import sys
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from pathlib import Path
+from unittest import mock
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.services import script_cache
+from app.services.script_cache import TopicCache, RETENTION_DAYS
+
+
+class TestTopicCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_file = Path(self.tmp_dir.name) / "topic_history.json"
+        self.caches = []
+
+    def tearDown(self):
+        # flush before the directory goes away instead of at interpreter exit
+        for cache in self.caches:
+            cache._save_cache()
+        self.tmp_dir.cleanup()
+
+    def make_cache(self):
+        cache = TopicCache(self.cache_file)
+        self.caches.append(cache)
+        return cache
+
+    def test_usage_count(self):
+        cache = self.make_cache()
+        cache.record_usage("chan", "a")
+        cache.record_usage("chan", "a")
+        cache.record_usage("other", "a")
+
+        self.assertEqual(cache.get_usage_count("chan", "a"), 2)
+        self.assertEqual(cache.get_usage_count("other", "a"), 1)
+        self.assertEqual(cache.get_usage_count("chan", "b"), 0)
+
+    def test_smart_topic_prefers_unused_then_least_used(self):
+        cache = self.make_cache()
+        topics = ["a", "b", "c"]
+        cache.record_usage("chan", "a")
+        cache.record_usage("chan", "b")
+
+        self.assertEqual(cache.get_unused_topic("chan", topics), "c")
+        self.assertEqual(cache.get_smart_topic("chan", topics), "c")
+
+        cache.record_usage("chan", "c")
+        cache.record_usage("chan", "a")
+        self.assertIsNone(cache.get_unused_topic("chan", topics))
+        self.assertIn(cache.get_least_used_topic("chan", topics), ["b", "c"])
+
+    def test_recent_topics(self):
+        cache = self.make_cache()
+        for topic in ["a", "b", "a", "c"]:
+            cache.record_usage("chan", topic)
+
+        self.assertEqual(cache.get_recent_topics("chan"), ["c", "a", "b"])
+        self.assertEqual(cache.get_recent_topics("chan", limit=2), ["c", "a"])
+        self.assertEqual(cache.get_recent_topics("missing"), [])
+
+    def test_persists_between_instances(self):
+        cache = self.make_cache()
+        cache.record_usage("chan", "a")
+        cache.record_usage("chan", "b")
+        cache._save_cache()
+
+        reloaded = self.make_cache()
+        self.assertEqual(reloaded.get_usage_count("chan", "a"), 1)
+        self.assertEqual(reloaded.get_recent_topics("chan"), ["b", "a"])
+
+    def test_usages_are_batched_until_flush(self):
+        with mock.patch.object(script_cache.threading, "Timer") as timer:
+            cache = self.make_cache()
+            # the first usage after a quiet period is written straight away
+            cache.record_usage("chan", "a")
+            self.assertEqual(cache._pending, [])
+            self.assertTrue(cache.log_file.exists())
+            timer.assert_not_called()
+
+            # later ones wait for the batch or the timer
+            cache.record_usage("chan", "b")
+            self.assertEqual(len(cache._pending), 1)
+            timer.assert_called_once()
+            interval, callback = timer.call_args.args
+            self.assertEqual(interval, script_cache.SAVE_INTERVAL_SEC)
+
+            callback()
+            self.assertEqual(cache._pending, [])
+
+        reloaded = self.make_cache()
+        self.assertEqual(reloaded.get_usage_count("chan", "b"), 1)
+
+    def test_full_batch_is_flushed(self):
+        cache = self.make_cache()
+        cache.record_usage("chan", "a")
+        for i in range(script_cache.SAVE_BATCH - 1):
+            cache.record_usage("chan", f"topic {i}")
+        self.assertEqual(len(cache._pending), script_cache.SAVE_BATCH - 1)
+
+        cache.record_usage("chan", "last")
+        self.assertEqual(cache._pending, [])
+
+    def test_compaction_folds_log_into_snapshot(self):
+        with mock.patch.object(script_cache, "COMPACT_MIN_ENTRIES", 2):
+            cache = self.make_cache()
+            for topic in ["a", "b", "a", "c", "a"]:
+                cache.record_usage("chan", topic)
+            cache._save_cache()
+
+        self.assertTrue(self.cache_file.exists())
+        self.assertNotIn(b'"topic"', cache.log_file.read_bytes())
+        snapshot = json.loads(self.cache_file.read_text(encoding="utf-8"))
+        self.assertEqual(
+            [(r["topic"], r["count"], len(r["timestamps"])) for r in snapshot["channels"]["chan"]],
+            [("a", 3, 3), ("b", 1, 1), ("c", 1, 1)],
+        )
+
+        cache.record_usage("chan", "d")
+        cache._save_cache()
+        reloaded = self.make_cache()
+        self.assertEqual(reloaded.get_recent_topics("chan"), ["d", "a", "c", "b"])
+        self.assertEqual(reloaded.get_usage_count("chan", "a"), 3)
+
+    def test_shutdown_folds_log_into_snapshot(self):
+        cache = self.make_cache()
+        cache.record_usage("chan", "a")
+        cache.record_usage("chan", "b")
+        self.assertFalse(self.cache_file.exists())
+
+        cache._shutdown()
+        self.assertEqual(cache._pending, [])
+        self.assertNotIn(b'"topic"', cache.log_file.read_bytes())
+
+        # the snapshot alone is enough, e.g. when only it was committed
+        cache.log_file.unlink()
+        reloaded = self.make_cache()
+        self.assertEqual(reloaded.get_recent_topics("chan"), ["b", "a"])
+
+    def test_interrupted_compaction_does_not_duplicate_usages(self):
+        cache = self.make_cache()
+        cache.record_usage("chan", "a")
+        cache._save_cache()
+        log_data = cache.log_file.read_bytes()
+
+        # crash between replacing the snapshot and deleting the log
+        cache._compact()
+        cache.log_file.write_bytes(log_data)
+
+        reloaded = self.make_cache()
+        self.assertEqual(reloaded.get_usage_count("chan", "a"), 1)
+
+    def test_sequence_continues_from_log_header(self):
+        cache = self.make_cache()
+        cache.record_usage("chan", "a")
+        cache._compact()
+
+        # without the snapshot, the compacted log still knows where numbering stopped
+        self.cache_file.unlink()
+        reloaded = self.make_cache()
+        reloaded.record_usage("chan", "b")
+        self.assertEqual(reloaded._seq, 2)
+
+    def test_log_replay_ignores_wall_clock(self):
+        cache = self.make_cache()
+        cache.record_usage("chan", "a")
+        cache._compact()
+
+        # a snapshot written "later" than the next usage, e.g. after a clock step back
+        snapshot = json.loads(self.cache_file.read_text(encoding="utf-8"))
+        snapshot["last_updated"] = (datetime.now() + timedelta(hours=2)).isoformat()
+        self.cache_file.write_text(json.dumps(snapshot), encoding="utf-8")
+
+        reloaded = self.make_cache()
+        reloaded.record_usage("chan", "b")
+        reloaded._save_cache()
+        again = self.make_cache()
+        self.assertEqual(again.get_usage_count("chan", "a"), 1)
+        self.assertEqual(again.get_usage_count("chan", "b"), 1)
+
+    def test_truncated_log_line_is_skipped(self):
+        cache = self.make_cache()
+        cache.record_usage("chan", "a")
+        cache._save_cache()
+        with open(cache.log_file, "a", encoding="utf-8") as f:
+            f.write('{"channel": "chan", "top')
+
+        reloaded = self.make_cache()
+        self.assertEqual(reloaded.get_usage_count("chan", "a"), 1)
+
+        # usages appended after the cut-off line must survive the next reload
+        reloaded.record_usage("chan", "b")
+        reloaded._save_cache()
+        again = self.make_cache()
+        self.assertEqual(again.get_usage_count("chan", "a"), 1)
+        self.assertEqual(again.get_usage_count("chan", "b"), 1)
+
+    def test_unreadable_snapshot_is_kept_aside(self):
+        self.cache_file.write_text('{"history": [', encoding="utf-8")
+
+        cache = self.make_cache()
+        self.assertEqual(cache.get_recent_topics("chan"), [])
+        self.assertFalse(self.cache_file.exists())
+        self.assertTrue(Path(str(self.cache_file) + ".corrupt").exists())
+
+    def test_snapshot_that_cannot_be_read_is_left_alone(self):
+        cache = self.make_cache()
+        cache.record_usage("chan", "a")
+        cache._compact()
+        snapshot = self.cache_file.read_bytes()
+
+        with mock.patch.object(Path, "read_bytes", side_effect=PermissionError("denied")):
+            reloaded = self.make_cache()
+            reloaded.get_usage_count("chan", "a")
+        reloaded._dirty = True
+        reloaded.record_usage("chan", "b")
+        reloaded._save_cache()
+
+        self.assertEqual(self.cache_file.read_bytes(), snapshot)
+        self.assertFalse(Path(str(self.cache_file) + ".corrupt").exists())
+        self.assertIn(b'"b"', reloaded.log_file.read_bytes())
+
+        again = self.make_cache()
+        self.assertEqual(again.get_usage_count("chan", "a"), 1)
+        self.assertEqual(again.get_usage_count("chan", "b"), 1)
+
+    def test_unusable_cache_directory_does_not_break_selection(self):
+        not_a_dir = Path(self.tmp_dir.name) / "notadir"
+        not_a_dir.write_text("", encoding="utf-8")
+
+        cache = TopicCache(not_a_dir / "sub" / "topic_history.json")
+        self.caches.append(cache)
+        self.assertEqual(cache.get_smart_topic("chan", ["a"]), "a")
+        cache.record_usage("chan", "a")
+        self.assertEqual(cache.get_usage_count("chan", "a"), 1)
+
+    def test_cache_file_is_read_on_first_use(self):
+        self.cache_file.write_text('{"channels": {', encoding="utf-8")
+
+        cache = self.make_cache()
+        self.assertTrue(self.cache_file.exists())
+
+        cache.get_usage_count("chan", "a")
+        self.assertFalse(self.cache_file.exists())
+
+    def test_cleanup_trims_expired_timestamps(self):
+        cache = self.make_cache()
+        cache.record_usage("chan", "a")
+        expired = (datetime.now() - timedelta(days=RETENTION_DAYS + 1)).timestamp()
+        cache._add_usage("chan", "a", expired)
+        cache._add_usage("chan", "b", expired)
+
+        cache._cleanup_expired()
+        self.assertEqual(cache.get_usage_count("chan", "a"), 1)
+        self.assertEqual(cache.get_usage_count("chan", "b"), 0)
+
+    def test_concurrent_first_use_waits_for_load(self):
+        cache = self.make_cache()
+        cache.record_usage("chan", "a")
+        cache.record_usage("chan", "b")
+        cache._compact()
+
+        reading = threading.Event()
+        release = threading.Event()
+        read_bytes = Path.read_bytes
+
+        def slow_read_bytes(path):
+            reading.set()
+            release.wait(5)
+            return read_bytes(path)
+
+        results = {}
+        reloaded = self.make_cache()
+        with mock.patch.object(Path, "read_bytes", slow_read_bytes):
+            loader = threading.Thread(
+                target=lambda: results.setdefault("count", reloaded.get_usage_count("chan", "a")))
+            loader.start()
+            reading.wait(5)
+            reader = threading.Thread(
+                target=lambda: results.setdefault("unused", reloaded.get_unused_topic("chan", ["a", "b"])))
+            reader.start()
+            # the second caller must block until the load has finished
+            reader.join(0.1)
+            self.assertTrue(reader.is_alive())
+            release.set()
+            loader.join(5)
+            reader.join(5)
+
+        self.assertEqual(results, {"count": 1, "unused": None})
+
+    def test_expired_entries_are_dropped(self):
+        expired = datetime.now() - timedelta(days=RETENTION_DAYS + 1)
+        recent = datetime.now() - timedelta(days=1)
+        self.cache_file.write_text(json.dumps({
+            "last_updated": recent.isoformat(),
+            "history": [
+                {"channel": "chan", "topic": "old", "timestamp": expired.isoformat()},
+                {"channel": "chan", "topic": "new", "timestamp": recent.isoformat()},
+            ],
+        }), encoding="utf-8")
+
+        cache = self.make_cache()
+        self.assertEqual(cache.get_usage_count("chan", "old"), 0)
+        self.assertEqual(cache.get_usage_count("chan", "new"), 1)
+        self.assertEqual(cache.get_unused_topic("chan", ["old", "new"]), "old")
+        self.assertEqual(cache.get_recent_topics("chan"), ["new"])
+        # the cleanup is only written out with the next flush
+        self.assertIn('"old"', self.cache_file.read_text(encoding="utf-8"))
+        cache._save_cache()
+        self.assertNotIn('"old"', self.cache_file.read_text(encoding="utf-8"))
+
+
+if __name__ == "__main__":
+    unittest.main()